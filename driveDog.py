@@ -1,34 +1,157 @@
 import os
+import errno
 import time
-import io
 import logging
 import logging.handlers
-import filecmp
 import shutil
 import dotenv
 import hashlib
+import queue
+import random
+import json
+import multiprocessing
+import sqlite3
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
 
+import httplib2
+import google_auth_httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload, set_user_agent
+
+
+# Read once at import, before any threads exist; os.umask can only be queried by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+LOG_FORMATTER = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+USER_AGENT = 'drivedog (gzip)'
+HTTP_CACHE_DIR = '.http_cache'
+HTTP_TIMEOUT = 30
+DOWNLOAD_WORKERS = 16
+# Bound on in-flight items between pipeline stages, for backpressure
+PIPELINE_QUEUE_SIZE = 32
+QUEUE_POLL_INTERVAL = 0.5  # seconds
+# Drive rejects large batches with 500s; keep each multipart request small
+BATCH_SIZE = 25
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+HASH_BLOCK_SIZE = 1 << 20  # 1 MiB
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+# Outcomes of comparing a local file's stat against Drive metadata
+LOCAL_UNCHANGED = 'unchanged'
+LOCAL_NEEDS_DOWNLOAD = 'download'
+LOCAL_NEEDS_HASH = 'hash'
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024  # 5 MB
+NUM_RETRIES = 5
+MAX_BACKOFF = 64  # seconds
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def execute_with_backoff(request):
+    for attempt in range(NUM_RETRIES + 1):
+        retry_after = None
+        try:
+            return request.execute()
+        except HttpError as e:
+            status = e.resp.status
+            rate_limited = status == 403 and (
+                b'rateLimitExceeded' in e.content or b'userRateLimitExceeded' in e.content
+            )
+            if attempt == NUM_RETRIES or not (status in RETRY_STATUSES or rate_limited):
+                raise
+            retry_after = e.resp.get('retry-after')
+            reason = f"Drive returned {status}"
+        except OSError as e:
+            # Socket timeouts, connection resets and SSL errors are transient too
+            if attempt == NUM_RETRIES:
+                raise
+            reason = f"Connection error ({e!r})"
+
+        delay = min(MAX_BACKOFF, 2 ** attempt) + random.uniform(0, 1)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        logging.warning(f"{reason}; retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+
+def _walk_files(root):
+    # DirEntry type checks come from the directory listing itself, no extra stat per entry
+    with os.scandir(root) as entries:
+        for entry in entries:
+            # Like os.walk: don't recurse into symlinked directories, but do list symlinked files
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
+
+def _put_unless_stopped(work_queue, item, stop):
+    # A plain put() would block forever on a full queue whose consumers have died
+    while True:
+        try:
+            work_queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+
+def _sha256_worker(file_path):
+    # Top-level so ProcessPoolExecutor can pickle it. Errors are raised back to the parent,
+    # since logging in the worker process would bypass drive_sync.log
+    with open(file_path, "rb", buffering=HASH_BLOCK_SIZE) as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+        hash_sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            hash_sha256.update(chunk)
+        return hash_sha256.hexdigest()
+
+
+def _hash_result(future, file_path):
+    try:
+        return future.result()
+    except OSError as e:
+        logging.error("Error computing SHA-256 for %s: %s", file_path, e)
+        return None
 
 
 class DriveSync:
-    def __init__(self, credentials_path, drive_folder_id, log_drive_folder_id, local_folder, output_folder):
+    def __init__(self, credentials_path, drive_folder_id, log_drive_folder_id, local_folder, output_folder,
+                 download_workers=DOWNLOAD_WORKERS):
+        if download_workers < 1:
+            raise ValueError(f"download_workers must be at least 1, got {download_workers}")
+
         self.credentials = service_account.Credentials.from_service_account_file(
             credentials_path,
             scopes=['https://www.googleapis.com/auth/drive']
         )
-        self.service = build('drive', 'v3', credentials=self.credentials)
+        # Only metadata calls go through the cached client; download threads use
+        # uncached ones so media bodies are not duplicated into the cache directory
+        self.service = self.build_service(cache=httplib2.FileCache(HTTP_CACHE_DIR))
+        # httplib2.Http is not thread-safe, so each download thread gets its own service
+        self._thread_local = threading.local()
+        self.hashers = self.build_hash_pool()
+        # Per-cycle get_drive_files results, only populated while sync() runs
+        self._list_cache = None
 
         self.drive_folder_id = drive_folder_id
         self.log_drive_folder_id = log_drive_folder_id
         self.local_folder = local_folder
         self.output_folder = output_folder
+        self.download_workers = download_workers
 
         self.setup_logging()
+        self.setup_cache()
 
         self.ensure_dir(local_folder)
         self.ensure_dir(output_folder)
@@ -45,105 +168,306 @@ class DriveSync:
             backupCount=5
         )
         rotating_file_handler.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        rotating_file_handler.setFormatter(formatter)
+        rotating_file_handler.setFormatter(LOG_FORMATTER)
 
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(formatter)
+        console_handler.setFormatter(LOG_FORMATTER)
 
         logger.addHandler(rotating_file_handler)
         logger.addHandler(console_handler)
 
+    def build_service(self, cache=None):
+        # Google only gzips responses when the user-agent contains "gzip"; tagging the
+        # transport covers raw requests like batch envelopes that bypass the API model
+        http = set_user_agent(httplib2.Http(cache=cache, timeout=HTTP_TIMEOUT), USER_AGENT)
+        authed_http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=http)
+        return build('drive', 'v3', http=authed_http, cache_discovery=False)
+
+    def build_hash_pool(self):
+        # Hash workers are first started from pipeline threads, so never fork them from this
+        # (by then multi-threaded) process; the pool is reused across sync cycles
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context(start_method)
+        )
+
+    def thread_service(self):
+        service = getattr(self._thread_local, 'service', None)
+        if service is None:
+            service = self.build_service()
+            self._thread_local.service = service
+        return service
+
+    def setup_cache(self):
+        self.db = sqlite3.connect('drivesync.db')
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "id TEXT PRIMARY KEY, local_path TEXT, modified_time TEXT, "
+            "sha256 TEXT, local_mtime REAL, size INTEGER)"
+        )
+        # Local mirror of Drive metadata, kept current through changes.list
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS drive_items ("
+            "id TEXT PRIMARY KEY, name TEXT, parents TEXT, is_folder INTEGER, "
+            "sha256 TEXT, modified_time TEXT, size INTEGER)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
     def ensure_dir(self, directory):
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-    def get_drive_files(self, folder_id=None):
-
-        if folder_id is None:
-            folder_id = self.drive_folder_id
+    def has_files(self, directory):
+        # Emptied subdirectories are left behind by move_files, so look for actual files
+        walker = _walk_files(directory)
+        try:
+            return next(walker, None) is not None
+        except FileNotFoundError:
+            return False
+        finally:
+            walker.close()
 
-        logging.info(f"Fetching Drive files for folder {folder_id}")
-        results = []
+    def list_files(self, query, fields):
+        items = []
         page_token = None
-        
+
         while True:
             try:
-                query = f"'{folder_id}' in parents and trashed = false"
-                response = self.service.files().list(
+                response = execute_with_backoff(self.service.files().list(
                     q=query,
                     spaces='drive',
-                    fields='nextPageToken, files(id, name, mimeType, md5Checksum, modifiedTime)',
+                    fields=f'nextPageToken, files({fields})',
+                    pageSize=1000,
                     pageToken=page_token
-                ).execute()
-                
-                for item in response.get('files', []):
-                    if item['name'].startswith('drive_sync.log'):
-                        continue
+                ))
 
-                    if item['mimeType'] == 'application/vnd.google-apps.folder':
-                        sub_items = self.get_drive_files(item['id'])
-                        for sub_item in sub_items:
-                            sub_item['path'] = os.path.join(item['name'], sub_item.get('path', ''))
-                        results.extend(sub_items)
-                    else:
-                        item['path'] = item['name']
-                        results.append(item)
+                items.extend(response.get('files', []))
 
                 page_token = response.get('nextPageToken')
                 if not page_token:
                     break
-                    
+
+            except Exception as e:
+                logging.error(f"Error fetching Drive files: {str(e)}")
+                raise
+
+        return items
+
+    def get_state(self, key):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def store_drive_item(self, item, is_folder):
+        self.db.execute(
+            "INSERT OR REPLACE INTO drive_items (id, name, parents, is_folder, sha256, modified_time, size) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (item['id'], item['name'], json.dumps(item.get('parents', [])), int(is_folder),
+             item.get('sha256Checksum'), item.get('modifiedTime'), item.get('size'))
+        )
+
+    def index_drive_files(self):
+        logging.info("Indexing all Drive files")
+        # Take the change token before listing so nothing changed mid-listing is missed
+        start_page_token = execute_with_backoff(self.service.changes().getStartPageToken())['startPageToken']
+
+        # Flat listings of everything visible, split on mimeType so neither needs to return it
+        folders = self.list_files(
+            f"mimeType = '{FOLDER_MIME_TYPE}' and trashed = false",
+            'id, name, parents'
+        )
+        files = self.list_files(
+            f"mimeType != '{FOLDER_MIME_TYPE}' and trashed = false",
+            'id, name, sha256Checksum, modifiedTime, size, parents'
+        )
+
+        with self.db:
+            self.db.execute("DELETE FROM drive_items")
+            for folder in folders:
+                self.store_drive_item(folder, is_folder=True)
+            for file in files:
+                self.store_drive_item(file, is_folder=False)
+            self.set_state('start_page_token', start_page_token)
+
+    def apply_drive_changes(self, page_token):
+        with self.db:
+            while True:
+                response = execute_with_backoff(self.service.changes().list(
+                    pageToken=page_token,
+                    spaces='drive',
+                    pageSize=1000,
+                    fields='nextPageToken, newStartPageToken, changes(fileId, removed, '
+                           'file(id, name, mimeType, sha256Checksum, modifiedTime, size, parents, trashed))'
+                ))
+
+                for change in response.get('changes', []):
+                    file_id = change.get('fileId')
+                    if file_id is None:
+                        continue
+
+                    file = change.get('file')
+                    if change.get('removed') or file is None or file.get('trashed'):
+                        self.db.execute("DELETE FROM drive_items WHERE id = ?", (file_id,))
+                    else:
+                        self.store_drive_item(file, is_folder=file.get('mimeType') == FOLDER_MIME_TYPE)
+
+                if 'newStartPageToken' in response:
+                    self.set_state('start_page_token', response['newStartPageToken'])
+                    break
+                page_token = response['nextPageToken']
+
+    def refresh_drive_index(self):
+        page_token = self.get_state('start_page_token')
+        if page_token is None:
+            self.index_drive_files()
+            return
+
+        try:
+            self.apply_drive_changes(page_token)
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            logging.warning("Drive change token expired; re-indexing all files")
+            self.index_drive_files()
+
+    def get_drive_files(self, folder_id=None):
+
+        if folder_id is None:
+            folder_id = self.drive_folder_id
+
+        # Within a sync cycle listings are memoized per folder, and the index is refreshed only once
+        if self._list_cache is not None and folder_id in self._list_cache:
+            return self._list_cache[folder_id]
+
+        logging.info(f"Fetching Drive files for folder {folder_id}")
+        if not self._list_cache:
+            try:
+                self.refresh_drive_index()
             except Exception as e:
                 logging.error(f"Error fetching Drive files: {str(e)}")
                 raise
 
+        # Paths are rebuilt from the parents recorded in the local index
+        children_by_parent = defaultdict(list)
+        folder_ids = set()
+        rows = self.db.execute(
+            "SELECT id, name, parents, is_folder, sha256, modified_time, size FROM drive_items"
+        )
+        for file_id, name, parents, is_folder, sha256, modified_time, size in rows:
+            item = {'id': file_id, 'name': name}
+            if sha256 is not None:
+                item['sha256Checksum'] = sha256
+            if modified_time is not None:
+                item['modifiedTime'] = modified_time
+            if size is not None:
+                item['size'] = size
+            if is_folder:
+                folder_ids.add(file_id)
+            for parent in json.loads(parents):
+                children_by_parent[parent].append(item)
+
+        results = []
+        stack = [(folder_id, '')]
+        while stack:
+            parent_id, parent_path = stack.pop()
+            for item in children_by_parent[parent_id]:
+                if item['name'].startswith('drive_sync.log'):
+                    continue
+
+                path = os.path.join(parent_path, item['name'])
+                if item['id'] in folder_ids:
+                    stack.append((item['id'], path))
+                else:
+                    results.append(dict(item, path=path))
+
+        if self._list_cache is not None:
+            self._list_cache[folder_id] = results
         return results
 
-    def download_file(self, file_id, file_path):
+    def download_file(self, file_id, file_path, verify=None):
 
-        logging.info(f"Downloading file from Drive to {file_path}")
+        logging.info("Downloading file from Drive to %s", file_path)
+        partial_path = None
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            file_handle = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_handle, request)
-            done = False
-            
-            while not done:
-                status, done = downloader.next_chunk()
-                if status:
-                    logging.debug(f"Download progress: {int(status.progress() * 100)}%")
-
-            file_handle.seek(0)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-            with open(file_path, 'wb') as f:
-                f.write(file_handle.read())
-
-            logging.info(f"Finished downloading file: {file_path}")
+            request = self.thread_service().files().get_media(fileId=file_id)
+            target_dir = os.path.dirname(file_path)
+            os.makedirs(target_dir, exist_ok=True)
+
+            # Stream into a unique sibling temp file so a failed download never truncates the
+            # existing copy, and concurrent downloads never share a temp file
+            fd, partial_path = tempfile.mkstemp(
+                dir=target_dir, prefix=f".{os.path.basename(file_path)}.", suffix='.part'
+            )
+            # mkstemp creates the file 0600; give the final file the usual permissions
+            os.chmod(partial_path, 0o666 & ~UMASK)
+            with os.fdopen(fd, 'wb') as file_handle:
+                downloader = MediaIoBaseDownload(file_handle, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+                done = False
+
+                while not done:
+                    status, done = downloader.next_chunk(num_retries=NUM_RETRIES)
+                    if status:
+                        logging.debug("Download progress: %d%%", int(status.progress() * 100))
+
+            # Check the temp file before it replaces anything, so a bad download is discarded
+            if verify is not None and not verify(partial_path):
+                raise ValueError("checksum mismatch")
+            os.replace(partial_path, file_path)
+
+            logging.info("Finished downloading file: %s", file_path)
             return True
+        except BrokenProcessPool:
+            # Not a per-file failure; let the pipeline restart the hash pool
+            raise
         except Exception as e:
-            logging.error(f"Error downloading file {file_path}: {str(e)}")
+            logging.error("Error downloading file %s: %s", file_path, e)
             return False
+        finally:
+            if partial_path is not None and os.path.exists(partial_path):
+                os.remove(partial_path)
 
     def move_files(self, intake_dir, output_dir):
 
-        for root, dirs, files in os.walk(intake_dir):
-            relative_path = os.path.relpath(root, intake_dir)
-            target_dir = os.path.join(output_dir, relative_path)
-            self.ensure_dir(target_dir)
-            
-            for file in files:
-                src_file_path = os.path.join(root, file)
-                dst_file_path = os.path.join(target_dir, file)
-
-                if os.path.exists(dst_file_path):
-                    logging.info(f"Overwriting existing file in output: {dst_file_path}")
-                    os.remove(dst_file_path)
-                
-                shutil.copy2(src_file_path, dst_file_path)
-                logging.info(f"Copied file {file} to {dst_file_path}")
+        created_dirs = set()
+        for entry in _walk_files(intake_dir):
+            src_file_path = entry.path
+            dst_file_path = os.path.join(output_dir, os.path.relpath(src_file_path, intake_dir))
+
+            target_dir = os.path.dirname(dst_file_path)
+            if target_dir not in created_dirs:
+                os.makedirs(target_dir, exist_ok=True)
+                created_dirs.add(target_dir)
+
+            if os.path.exists(dst_file_path):
+                logging.info("Overwriting existing file in output: %s", dst_file_path)
+
+            # Renaming a symlink would move the link itself; copy its target's content instead
+            if not entry.is_symlink():
+                try:
+                    os.replace(src_file_path, dst_file_path)
+                    logging.info("Moved file %s to %s", entry.name, dst_file_path)
+                    continue
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+            # Intake and output live on different filesystems (or the entry is a symlink);
+            # fall back to copy + delete
+            shutil.copy2(src_file_path, dst_file_path)
+            os.remove(src_file_path)
+            logging.info("Copied file %s to %s", entry.name, dst_file_path)
+
+    def _log_delete_callback(self, request_id, response, exception):
+        if exception is not None:
+            logging.error(f"Error deleting old log file (ID: {request_id}): {str(exception)}")
+        else:
+            logging.info(f"Deleted old log file (ID: {request_id})")
 
     def upload_log_file(self, local_log_path, folder_id):
         if not os.path.exists(local_log_path):
@@ -154,24 +478,28 @@ class DriveSync:
             log_filename = os.path.basename(local_log_path)
 
             query = f"'{folder_id}' in parents and name = '{log_filename}' and trashed = false"
-            response = self.service.files().list(q=query, fields="files(id, name)").execute()
+            response = execute_with_backoff(self.service.files().list(q=query, fields="files(id, name)"))
 
-            for file in response.get('files', []):
-                file_id = file['id']
-                self.service.files().delete(fileId=file_id).execute()
-                logging.info(f"Deleted old log file: {file['name']} (ID: {file_id})")
+            old_files = response.get('files', [])
+            for start in range(0, len(old_files), BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=self._log_delete_callback)
+                for file in old_files[start:start + BATCH_SIZE]:
+                    batch.add(self.service.files().delete(fileId=file['id']), request_id=file['id'])
+                execute_with_backoff(batch)
 
             file_metadata = {
                 'name': log_filename,
                 'parents': [folder_id]
             }
-            media = MediaFileUpload(local_log_path, mimetype='text/plain', resumable=True)
+            # Small logs go up in a single multipart request instead of a resumable session
+            resumable = os.path.getsize(local_log_path) > RESUMABLE_THRESHOLD
+            media = MediaFileUpload(local_log_path, mimetype='text/plain', resumable=resumable)
 
-            created_file = self.service.files().create(
+            created_file = execute_with_backoff(self.service.files().create(
                 body=file_metadata,
                 media_body=media,
                 fields='id'
-            ).execute()
+            ))
 
             logging.info(f"Uploaded '{local_log_path}' to Drive folder '{folder_id}'. File ID: {created_file.get('id')}")
             return True
@@ -183,32 +511,60 @@ class DriveSync:
 
     def sync(self):
         logging.info("=== Starting sync process ===")
+        self._list_cache = {}
         try:
             drive_files = self.get_drive_files()
 
+            # Drive allows same-named siblings; they share a local path, so only the most
+            # recently modified one is synced
+            newest_by_path = {}
+            duplicated_paths = set()
             for drive_file in drive_files:
                 relative_path = drive_file.get('path', drive_file['name'])
                 local_path = os.path.join(self.output_folder, relative_path)
+                current = newest_by_path.get(local_path)
+                if current is not None:
+                    duplicated_paths.add(local_path)
+                    if current['modifiedTime'] >= drive_file['modifiedTime']:
+                        continue
+                newest_by_path[local_path] = drive_file
+            for local_path in duplicated_paths:
+                logging.warning("Multiple Drive files map to %s; keeping the newest", local_path)
 
+            downloads = []
+            to_hash = []
+            for local_path, drive_file in newest_by_path.items():
                 if os.path.exists(local_path):
-                    local_md5 = self.md5(local_path)
-                    drive_md5 = drive_file.get('md5Checksum')
-                    if local_md5 == drive_md5:
-                        logging.info(f"Skipping {local_path}, already up-to-date.")
-                        continue 
+                    if self.is_cached(local_path, drive_file):
+                        logging.info("Skipping %s, unchanged since last sync.", local_path)
+                        continue
 
-                self.download_file(drive_file['id'], local_path)
+                    status = self.compare_local_file(local_path, drive_file)
+                    if status == LOCAL_UNCHANGED:
+                        logging.info("Skipping %s, size and mtime match.", local_path)
+                        self.record_file(drive_file, local_path)
+                        continue
 
-            self.move_files(self.local_folder, self.output_folder)
+                    if status == LOCAL_NEEDS_HASH:
+                        to_hash.append((drive_file, local_path))
+                        continue
+
+                downloads.append((drive_file, local_path))
+
+            if to_hash or downloads:
+                try:
+                    self.run_pipeline(to_hash, downloads)
+                except BrokenProcessPool as e:
+                    # A dead hash worker (OOM kill, crash) breaks the pool for good; replace it so
+                    # this cycle still moves intake files and uploads the log, and the next one retries
+                    logging.error("Hash worker pool failed, restarting it: %s", e)
+                    self.hashers.shutdown(wait=False, cancel_futures=True)
+                    self.hashers = self.build_hash_pool()
+            self.db.commit()
 
-            for root, dirs, files in os.walk(self.local_folder):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        os.remove(file_path)
-                        logging.info(f"Deleted cahced file: {file_path}")
-                    except Exception as e:
-                        logging.error(f"Error deleting cached {file_path}: {str(e)}")
+            # The intake folder is usually empty; don't walk it for nothing
+            if self.has_files(self.local_folder):
+                self.move_files(self.local_folder, self.output_folder)
 
             logging.info("=== Sync process complete ===")
 
@@ -216,19 +572,154 @@ class DriveSync:
 
         except Exception as e:
             logging.error(f"Sync error: {str(e)}")
+        finally:
+            self._list_cache = None
+
+    def run_pipeline(self, to_hash, downloads):
+        # Stages: producer thread (hash existing files, queue downloads) -> download threads
+        # (fetch + verify in the hash pool) -> this thread (record results in SQLite)
+        download_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        commit_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        stop = threading.Event()
+
+        hashers = self.hashers
+        with ThreadPoolExecutor(max_workers=self.download_workers + 1) as threads:
+            producer = threads.submit(
+                self.produce_downloads, to_hash, downloads, hashers, download_queue, commit_queue, stop
+            )
+            workers = [
+                threads.submit(self.download_worker, download_queue, hashers, commit_queue, stop)
+                for _ in range(self.download_workers)
+            ]
+
+            # Each download worker posts None once it has drained the download queue
+            finished_workers = 0
+            try:
+                while finished_workers < self.download_workers:
+                    task = commit_queue.get()
+                    if task is None:
+                        finished_workers += 1
+                        continue
+                    self.record_file(*task)
+            finally:
+                if finished_workers < self.download_workers:
+                    # Wind the other stages down, and keep draining so none of them
+                    # block forever on a full commit queue
+                    stop.set()
+                    while finished_workers < self.download_workers:
+                        if commit_queue.get() is None:
+                            finished_workers += 1
+
+            producer.result()
+            for worker in workers:
+                worker.result()
+
+    def produce_downloads(self, to_hash, downloads, hashers, download_queue, commit_queue, stop):
+        hashes = {}
+        try:
+            hashes = {
+                hashers.submit(_sha256_worker, local_path): (drive_file, local_path)
+                for drive_file, local_path in to_hash
+            }
+            for task in downloads:
+                if not _put_unless_stopped(download_queue, task, stop):
+                    return
+
+            for future in as_completed(hashes):
+                if stop.is_set():
+                    return
+                drive_file, local_path = hashes[future]
+                if _hash_result(future, local_path) == drive_file.get('sha256Checksum'):
+                    logging.info("Skipping %s, already up-to-date.", local_path)
+                    commit_queue.put((drive_file, local_path))
+                elif not _put_unless_stopped(download_queue, (drive_file, local_path), stop):
+                    return
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for future in hashes:
+                future.cancel()
+            for _ in range(self.download_workers):
+                if not _put_unless_stopped(download_queue, None, stop):
+                    break
 
-    def md5(self, file_path):
+    def download_worker(self, download_queue, hashers, commit_queue, stop):
+        try:
+            while True:
+                task = download_queue.get()
+                if task is None:
+                    break
+                if stop.is_set():
+                    continue
+
+                drive_file, local_path = task
+                expected_sha256 = drive_file.get('sha256Checksum')
+                verify = None
+                if expected_sha256 is not None:
+                    def verify(path, expected_sha256=expected_sha256):
+                        return _hash_result(hashers.submit(_sha256_worker, path), path) == expected_sha256
+
+                try:
+                    if self.download_file(drive_file['id'], local_path, verify=verify):
+                        commit_queue.put(task)
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    logging.error("Error processing download %s: %s", local_path, e)
+        except BaseException:
+            # This worker is gone; make the other stages wind down instead of waiting on it
+            stop.set()
+            raise
+        finally:
+            # The commit stage counts these, so one must be posted however the worker exits
+            commit_queue.put(None)
+
+    def is_cached(self, local_path, drive_file):
+        row = self.db.execute(
+            "SELECT local_path, modified_time, local_mtime, size FROM files WHERE id = ?",
+            (drive_file['id'],)
+        ).fetchone()
+        if row is None:
+            return False
 
-        hash_md5 = hashlib.md5()
+        cached_path, modified_time, local_mtime, size = row
+        if cached_path != local_path or modified_time != drive_file['modifiedTime']:
+            return False
         try:
-            with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-        except Exception as e:
-            logging.error(f"Error computing MD5 for {file_path}: {e}")
-            return None
-        return hash_md5.hexdigest()
+            stat = os.stat(local_path)
+        except OSError:
+            return False
+        # A local edit since the last sync invalidates the row
+        return stat.st_size == size and stat.st_mtime == local_mtime
 
+    def record_file(self, drive_file, local_path):
+        try:
+            stat = os.stat(local_path)
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (id, local_path, modified_time, sha256, local_mtime, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (drive_file['id'], local_path, drive_file['modifiedTime'],
+                 drive_file.get('sha256Checksum'), stat.st_mtime, stat.st_size)
+            )
+        except (OSError, sqlite3.Error) as e:
+            logging.error("Error recording %s in sync cache: %s", local_path, e)
+
+    def compare_local_file(self, local_path, drive_file):
+        # Native Google files report no size and always fall through to hashing
+        if 'size' not in drive_file:
+            return LOCAL_NEEDS_HASH
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return LOCAL_NEEDS_DOWNLOAD
+        # Different sizes already prove the content differs
+        if stat.st_size != int(drive_file['size']):
+            return LOCAL_NEEDS_DOWNLOAD
+        modified_time = datetime.fromisoformat(drive_file['modifiedTime'].replace('Z', '+00:00'))
+        if stat.st_mtime >= modified_time.timestamp():
+            return LOCAL_UNCHANGED
+        return LOCAL_NEEDS_HASH
 
     def start_continuous_sync(self, interval=60):
         logging.info(f"Starting continuous sync; interval: {interval} seconds.")
@@ -256,6 +747,8 @@ if __name__ == "__main__":
     OUTPUT_FOLDER = os.getenv("OUTPUT_FOLDER")
 
     SYNC_INTERVAL = int(os.getenv("SYNC_INT"))
+    DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", DOWNLOAD_WORKERS))
     
-    sync = DriveSync(CREDENTIALS_PATH, DRIVE_FOLDER_ID, LOG_DRIVE_FOLDER_ID, LOCAL_FOLDER, OUTPUT_FOLDER)
+    sync = DriveSync(CREDENTIALS_PATH, DRIVE_FOLDER_ID, LOG_DRIVE_FOLDER_ID, LOCAL_FOLDER, OUTPUT_FOLDER,
+                     download_workers=DOWNLOAD_WORKERS)
     sync.start_continuous_sync(SYNC_INTERVAL)